@@ -1,21 +1,30 @@
+import asyncio
+import contextlib
+import functools
 import logging
 import json
+import math
 import os
+import uuid
 from datetime import datetime
-from typing import Annotated, Optional, List, Dict, Any
+from typing import Annotated, Optional, List, Dict, Any, Set, Tuple
 from dataclasses import dataclass, asdict, field
 
 from dotenv import load_dotenv
+from prometheus_client import Histogram
 from pydantic import Field
 from livekit.agents import (
     Agent,
     AgentSession,
     JobContext,
     JobProcess,
+    MetricsCollectedEvent,
+    NOT_GIVEN,
     RoomInputOptions,
     WorkerOptions,
     cli,
     function_tool,
+    metrics,
     RunContext,
 )
 
@@ -24,6 +33,7 @@ from livekit.plugins import murf, silero, google, deepgram, noise_cancellation
 from livekit.plugins.turn_detector.multilingual import MultilingualModel
 
 logger = logging.getLogger("agent")
+logger.setLevel(logging.INFO)
 load_dotenv(".env.local")
 
 # ======================================================
@@ -80,7 +90,7 @@ def load_catalog() -> Dict[str, CatalogItem]:
         ]
         with open(path, "w", encoding='utf-8') as f:
             json.dump(sample_catalog, f, indent=4)
-        print(f"✅ Catalog seeded at {CATALOG_FILE}")
+        logger.info("catalog seeded at %s", CATALOG_FILE)
 
     with open(path, "r", encoding='utf-8') as f:
         data = json.load(f)
@@ -92,6 +102,15 @@ def load_catalog() -> Dict[str, CatalogItem]:
 # Initialize Catalog on load
 CATALOG = load_catalog()
 
+# Lowercased tag text per catalog key, built once for the fuzzy lookup in add_to_cart
+CATALOG_TAGS_TEXT: Dict[str, str] = {key: " ".join(item.tags).lower() for key, item in CATALOG.items()}
+
+# Recipes resolved against the catalog once, so bundle requests skip the per-ingredient lookups
+RECIPE_BUNDLES: Dict[str, List[Tuple[CatalogItem, int]]] = {
+    recipe: [(CATALOG[name.lower()], qty) for name, qty in ingredients if name.lower() in CATALOG]
+    for recipe, ingredients in RECIPES.items()
+}
+
 # ======================================================
 # 🧠 2. STATE MANAGEMENT (Cart)
 # ======================================================
@@ -130,6 +149,61 @@ class OrderingState:
         """Calculates the current total price of the cart."""
         return sum(item.quantity * item.price for item in self.cart)
 
+# ======================================================
+# 💾 ORDER PERSISTENCE
+# ======================================================
+
+# Keep strong references to in-flight saves so they are not garbage collected
+_pending_saves: Set[asyncio.Task] = set()
+
+@functools.lru_cache(maxsize=1)
+def get_orders_folder() -> str:
+    """Creates the orders folder once per process and returns its path."""
+    os.makedirs(ORDER_FOLDER, exist_ok=True)
+    return ORDER_FOLDER
+
+def save_order_to_json(order_object: Dict[str, Any]) -> str:
+    """Writes the order to its own JSON file and returns the file path."""
+    # The random suffix keeps two orders placed in the same second from overwriting each other
+    filename = os.path.join(get_orders_folder(), f"order_{order_object['order_id']}_{uuid.uuid4().hex[:8]}.json")
+
+    # Encode in one pass and write once instead of streaming many small chunks
+    payload = json.dumps(order_object, indent=4)
+
+    # Write to a temp file and rename it into place so a crash never leaves a truncated order
+    tmp_filename = filename + ".tmp"
+    try:
+        with open(tmp_filename, "w", encoding='utf-8') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        # Don't leave a stray .tmp behind when the write fails (e.g. disk full)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_filename)
+        raise
+
+    logger.info("order placed, saved to %s", filename)
+    return filename
+
+def _on_save_done(task: asyncio.Task) -> None:
+    """Releases the task reference and surfaces any save error in the logs."""
+    _pending_saves.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("failed to save order", exc_info=task.exception())
+
+def schedule_order_save(order_object: Dict[str, Any]) -> None:
+    """Runs `save_order_to_json` on the default thread pool without blocking the event loop."""
+    task = asyncio.create_task(asyncio.to_thread(save_order_to_json, order_object))
+    _pending_saves.add(task)
+    task.add_done_callback(_on_save_done)
+
+async def flush_pending_saves() -> None:
+    """Waits for any in-flight order saves so they are not lost when the job shuts down."""
+    if _pending_saves:
+        await asyncio.gather(*_pending_saves, return_exceptions=True)
+
 # ======================================================
 # 🛠️ 3. ORDERING AGENT TOOLS
 # ======================================================
@@ -149,29 +223,26 @@ async def add_to_cart(
     
     # 1. Check for Recipe Match (Intelligent Bundling)
     recipe_key = item_or_recipe_name.lower().replace("ingredients for ", "").strip()
-    if recipe_key in RECIPES:
+    if recipe_key in RECIPE_BUNDLES:
         items_added = []
-        for item_name, default_qty in RECIPES[recipe_key]:
+        for cat_item, default_qty in RECIPE_BUNDLES[recipe_key]:
             # Scale quantity based on user request (e.g., "pasta for two people" might scale ingredients)
             final_qty = default_qty * quantity 
 
-            if item_name.lower() in CATALOG:
-                cat_item = CATALOG[item_name.lower()]
-                
-                # Check if item is already in the cart
-                existing_item = next((i for i in state.cart if i.name.lower() == item_name.lower()), None)
-
-                if existing_item:
-                    existing_item.quantity += final_qty
-                else:
-                    new_item = CartItem(
-                        name=cat_item.name,
-                        quantity=final_qty,
-                        price=cat_item.price,
-                        notes=notes if notes else "",
-                    )
-                    state.cart.append(new_item)
-                items_added.append(f"{final_qty} x {cat_item.name}")
+            # Check if item is already in the cart
+            existing_item = next((i for i in state.cart if i.name == cat_item.name), None)
+
+            if existing_item:
+                existing_item.quantity += final_qty
+            else:
+                new_item = CartItem(
+                    name=cat_item.name,
+                    quantity=final_qty,
+                    price=cat_item.price,
+                    notes=notes if notes else "",
+                )
+                state.cart.append(new_item)
+            items_added.append(f"{final_qty} x {cat_item.name}")
         
         return f"SUCCESS: Added ingredients for '{recipe_key}' to the cart: {', '.join(items_added)}."
 
@@ -179,16 +250,16 @@ async def add_to_cart(
     item_key = item_or_recipe_name.lower()
     if item_key not in CATALOG:
         # Try a fuzzy search on the catalog
-        match = next((i for k, i in CATALOG.items() if item_key in k or item_key in " ".join(i.tags).lower()), None)
+        match = next((k for k, tags in CATALOG_TAGS_TEXT.items() if item_key in k or item_key in tags), None)
         if match:
-            item_key = match.name.lower()
+            item_key = match
         else:
             return f"ERROR: I could not find '{item_or_recipe_name}' in the catalog. Please try a different item or check the spelling."
 
     cat_item = CATALOG[item_key]
     
-    # Check if item is already in the cart
-    existing_item = next((i for i in state.cart if i.name.lower() == item_key), None)
+    # Check if item is already in the cart (cart names are always the canonical catalog name)
+    existing_item = next((i for i in state.cart if i.name == cat_item.name), None)
 
     if existing_item:
         existing_item.quantity += quantity
@@ -216,7 +287,7 @@ async def place_order(
     ctx: RunContext[OrderingState],
     customer_name: Annotated[str, Field(description="The customer's name for the order.")],
     customer_address: Annotated[str, Field(description="The customer's address for delivery.")]
-) -> str:
+) -> Optional[str]:
     """
     💾 Finalizes the order, calculates the total, and saves the order to a JSON file. 
     Call this when the user says they are done, e.g., 'That's all' or 'Place my order.'
@@ -226,7 +297,8 @@ async def place_order(
         return "ERROR: The cart is empty. Please add items before placing an order."
 
     # 1. Prepare Order Data
-    order_id = datetime.now().strftime("%Y%m%d%H%M%S")
+    placed_at = datetime.now()
+    order_id = placed_at.strftime("%Y%m%d%H%M%S")
     order_total = state.calculate_total()
     
     order_items = [
@@ -242,7 +314,7 @@ async def place_order(
 
     order_object = {
         "order_id": order_id,
-        "timestamp": datetime.now().isoformat(),
+        "timestamp": placed_at.isoformat(),
         "customer_info": {
             "name": customer_name,
             "address": customer_address,
@@ -251,65 +323,114 @@ async def place_order(
         "order_total": round(order_total, 2)
     }
 
-    # 2. Save to JSON file
-    os.makedirs(ORDER_FOLDER, exist_ok=True)
-    filename = os.path.join(ORDER_FOLDER, f"order_{order_id}.json")
-    
-    try:
-        with open(filename, "w", encoding='utf-8') as f:
-            json.dump(order_object, f, indent=4)
-        
-        print(f"✅ ORDER PLACED: Saved to {filename}")
+    # 2. Save to JSON file in the background so the confirmation is not delayed by disk I/O
+    schedule_order_save(order_object)
 
-        # 3. Clear cart after successful placement
-        state.cart = [] 
-        state.customer_name = customer_name
-        state.customer_address = customer_address
-        
-        return (f"SUCCESS: Your order (ID: {order_id}) has been placed. The total is ${order_total:.2f}. "
-                f"I've saved the details to a JSON file. Thank you for shopping with us! Goodbye.")
+    # 3. Clear cart once the order has been handed off
+    state.cart = [] 
+    state.customer_name = customer_name
+    state.customer_address = customer_address
     
-    except Exception as e:
-        return f"ERROR: Failed to save the order file. Details: {str(e)}"
+    # 4. Speak the fixed confirmation straight to TTS rather than having the LLM regenerate it
+    ctx.session.say(
+        f"Your order (ID: {order_id}) has been placed. The total is ${order_total:.2f}. "
+        "Thank you for shopping with us! Goodbye."
+    )
+
+    # No tool output means no follow-up LLM generation after the goodbye
+    return None
 
 # ======================================================
 # 🤖 4. AGENT DEFINITION
 # ======================================================
 
+# Built once at import so every session reuses the same prompt string
+ORDERING_INSTRUCTIONS = """
+    You are 'Nick', the friendly Food & Grocery Ordering Assistant for 'Daily Pantry'.
+    Your primary goal is to efficiently take the user's order and finalize it.
+
+    🛒 **ORDERING PROTOCOL (FOLLOW STRICTLY):**
+    
+    1. **GREETING & INSTRUCTION:**
+        - Greet the user warmly.
+        - State clearly: "I can help you order groceries, snacks, and prepared meals. You can tell me individual items or even things like 'I need ingredients for a peanut butter sandwich'."
+
+    2. **ADDING ITEMS:**
+        - Use the `add_to_cart` tool for every item requested, including quantity and any notes (like 'gluten-free').
+        - Extract every item the user mentions in a turn and issue all the `add_to_cart` calls together in a single response, rather than one item per turn.
+        - **CRITICAL:** If the user asks for "ingredients for X", use the full phrase as the `item_or_recipe_name` in the `add_to_cart` tool.
+        - After the tool calls return SUCCESS, confirm all the item(s) added in one reply, along with the current item count.
+
+    3. **CART MANAGEMENT:**
+        - When the user asks "What's in my cart?", use the `list_cart_contents` tool.
+        - The LLM's response should paraphrase the summary returned by the tool.
+
+    4. **FINALIZATION & CHECKOUT:**
+        - When the user says they are done (e.g., "That's all," "Checkout," "Place my order"):
+            a. Politely ask for their **Name** and **Delivery Address**.
+            b. Once you have both pieces of information, use the `place_order` tool with the name and address.
+        - The `place_order` tool speaks the order confirmation and goodbye itself. Do not say anything after calling it.
+    
+    **Available Catalog Categories:** Groceries, Snacks, Prepared Food.
+    **TONE:** Friendly, efficient, and helpful. Always confirm changes verbally.
+    """
+
 class OrderingAgent(Agent):
     def __init__(self):
         super().__init__(
-            instructions=f"""
-            You are 'Nick', the friendly Food & Grocery Ordering Assistant for 'Daily Pantry'.
-            Your primary goal is to efficiently take the user's order and finalize it.
-
-            🛒 **ORDERING PROTOCOL (FOLLOW STRICTLY):**
-            
-            1. **GREETING & INSTRUCTION:**
-                - Greet the user warmly.
-                - State clearly: "I can help you order groceries, snacks, and prepared meals. You can tell me individual items or even things like 'I need ingredients for a peanut butter sandwich'."
-
-            2. **ADDING ITEMS:**
-                - Use the `add_to_cart` tool for every item requested, including quantity and any notes (like 'gluten-free').
-                - **CRITICAL:** If the user asks for "ingredients for X", use the full phrase as the `item_or_recipe_name` in the `add_to_cart` tool.
-                - After a tool call returns SUCCESS, verbally confirm the item(s) added and the current item count.
-
-            3. **CART MANAGEMENT:**
-                - When the user asks "What's in my cart?", use the `list_cart_contents` tool.
-                - The LLM's response should paraphrase the summary returned by the tool.
-
-            4. **FINALIZATION & CHECKOUT:**
-                - When the user says they are done (e.g., "That's all," "Checkout," "Place my order"):
-                    a. Politely ask for their **Name** and **Delivery Address**.
-                    b. Once you have both pieces of information, use the `place_order` tool with the name and address.
-                - The final verbal message must be the confirmation returned by the `place_order` tool.
-            
-            **Available Catalog Categories:** Groceries, Snacks, Prepared Food.
-            **TONE:** Friendly, efficient, and helpful. Always confirm changes verbally.
-            """,
+            instructions=ORDERING_INSTRUCTIONS,
             tools=[add_to_cart, list_cart_contents, place_order],
         )
 
+# ======================================================
+# 📈 LATENCY METRICS
+# ======================================================
+
+# Served by the worker's /metrics endpoint when PROMETHEUS_PORT is set. Job processes
+# only report into it when PROMETHEUS_MULTIPROC_DIR is also set before the worker starts.
+TURN_LATENCY = Histogram(
+    "voice_turn_latency_seconds",
+    "Per-turn voice pipeline latency by component",
+    ["component"],
+)
+
+@dataclass
+class LatencyStats:
+    """Collects per-turn latency samples (in seconds) for each pipeline component."""
+    eou_delay: List[float] = field(default_factory=list)
+    llm_ttft: List[float] = field(default_factory=list)
+    tts_ttfb: List[float] = field(default_factory=list)
+
+    def collect(self, m: metrics.AgentMetrics) -> None:
+        """Records the latency fields of a single metrics event."""
+        # An unknown end-of-utterance delay is reported as 0.0
+        if isinstance(m, metrics.EOUMetrics) and m.end_of_utterance_delay > 0:
+            self._record("eou_delay", self.eou_delay, m.end_of_utterance_delay)
+        elif isinstance(m, metrics.LLMMetrics):
+            self._record("llm_ttft", self.llm_ttft, m.ttft)
+        # Streams interrupted before their first audio frame report the ttfb=-1.0 sentinel
+        elif isinstance(m, metrics.TTSMetrics) and not m.cancelled and m.ttfb >= 0:
+            self._record("tts_ttfb", self.tts_ttfb, m.ttfb)
+
+    @staticmethod
+    def _record(component: str, samples: List[float], value: float) -> None:
+        samples.append(value)
+        TURN_LATENCY.labels(component=component).observe(value)
+
+    def get_summary(self) -> str:
+        """Returns p50/p95 for each component that produced samples."""
+        parts = []
+        for name, samples in (("eou_delay", self.eou_delay), ("llm_ttft", self.llm_ttft), ("tts_ttfb", self.tts_ttfb)):
+            if not samples:
+                continue
+            ordered = sorted(samples)
+            n = len(ordered)
+            # Nearest-rank percentiles, so p95 of a handful of turns still reports the slowest one
+            p50 = ordered[max(0, math.ceil(0.50 * n) - 1)]
+            p95 = ordered[max(0, math.ceil(0.95 * n) - 1)]
+            parts.append(f"{name} p50={p50:.3f}s p95={p95:.3f}s n={n}")
+        return ", ".join(parts) if parts else "no latency samples"
+
 # ======================================================
 # 🎬 ENTRYPOINT (Remains mostly the same, only class name changes)
 # ======================================================
@@ -320,16 +441,17 @@ def prewarm(proc: JobProcess):
 async def entrypoint(ctx: JobContext):
     ctx.log_context_fields = {"room": ctx.room.name}
 
-    print("\n" + "📦" * 25)
-    print("🚀 STARTING GROCERY ORDERING SESSION")
-    
+    logger.info("starting grocery ordering session")
+
     # 1. Initialize State
     userdata = OrderingState()
 
     # 2. Setup Agent
     session = AgentSession(
         stt=deepgram.STT(model="nova-3"),
-        llm=google.LLM(model="gemini-2.5-flash"), 
+        # flash-lite lowers time-to-first-token; the 256-token cap only bounds reply length
+        # while leaving room to read back a full cart.
+        llm=google.LLM(model="gemini-2.5-flash-lite", max_output_tokens=256, temperature=0.2),
         tts=murf.TTS(
             voice="en-US-marcus", 
             style="Conversational",        
@@ -339,6 +461,23 @@ async def entrypoint(ctx: JobContext):
         vad=ctx.proc.userdata["vad"],
         userdata=userdata,
     )
+
+    # Log every turn's metrics and summarize latency per component when the job ends
+    usage_collector = metrics.UsageCollector()
+    latency_stats = LatencyStats()
+
+    @session.on("metrics_collected")
+    def _on_metrics_collected(ev: MetricsCollectedEvent):
+        metrics.log_metrics(ev.metrics)
+        usage_collector.collect(ev.metrics)
+        latency_stats.collect(ev.metrics)
+
+    async def log_session_metrics():
+        logger.info("usage: %s", usage_collector.get_summary())
+        logger.info("latency: %s", latency_stats.get_summary())
+
+    ctx.add_shutdown_callback(log_session_metrics)
+    ctx.add_shutdown_callback(flush_pending_saves)
     
     # 3. Start
     await session.start(
@@ -352,4 +491,9 @@ async def entrypoint(ctx: JobContext):
     await ctx.connect()
 
 if __name__ == "__main__":
-    cli.run_app(WorkerOptions(entrypoint_fnc=entrypoint, prewarm_fnc=prewarm))
\ No newline at end of file
+    prometheus_port = os.getenv("PROMETHEUS_PORT")
+    cli.run_app(WorkerOptions(
+        entrypoint_fnc=entrypoint,
+        prewarm_fnc=prewarm,
+        prometheus_port=int(prometheus_port) if prometheus_port else NOT_GIVEN,
+    ))
\ No newline at end of file
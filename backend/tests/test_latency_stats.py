@@ -0,0 +1,82 @@
+import pytest
+from livekit.agents import metrics
+from prometheus_client import REGISTRY
+
+from agent import LatencyStats
+
+
+def _eou(delay: float) -> metrics.EOUMetrics:
+    return metrics.EOUMetrics(
+        timestamp=0.0,
+        end_of_utterance_delay=delay,
+        transcription_delay=0.0,
+        on_user_turn_completed_delay=0.0,
+    )
+
+
+def _tts(ttfb: float, cancelled: bool = False) -> metrics.TTSMetrics:
+    return metrics.TTSMetrics(
+        label="tts",
+        request_id="req",
+        timestamp=0.0,
+        ttfb=ttfb,
+        duration=1.0,
+        audio_duration=1.0,
+        cancelled=cancelled,
+        characters_count=10,
+        streamed=True,
+    )
+
+
+def test_skips_sentinel_samples() -> None:
+    """Cancelled/-1.0 TTS samples and 0.0 EOU delays are not recorded."""
+    stats = LatencyStats()
+    stats.collect(_tts(-1.0))
+    stats.collect(_tts(0.4, cancelled=True))
+    stats.collect(_tts(0.2))
+    stats.collect(_eou(0.0))
+    stats.collect(_eou(0.5))
+
+    assert stats.tts_ttfb == [0.2]
+    assert stats.eou_delay == [0.5]
+
+
+def test_exports_recorded_samples_to_histogram() -> None:
+    """Only samples that pass the sentinel filter reach the Prometheus histogram."""
+
+    def count() -> float:
+        labels = {"component": "tts_ttfb"}
+        return (
+            REGISTRY.get_sample_value("voice_turn_latency_seconds_count", labels) or 0
+        )
+
+    before = count()
+    stats = LatencyStats()
+    stats.collect(_tts(-1.0))
+    stats.collect(_tts(0.2))
+
+    assert count() - before == 1
+
+
+def test_summary_without_samples() -> None:
+    assert LatencyStats().get_summary() == "no latency samples"
+
+
+@pytest.mark.parametrize(
+    ("samples", "p50", "p95"),
+    [
+        ([0.3], 0.3, 0.3),
+        ([0.9, 0.1], 0.1, 0.9),
+        ([0.5, 0.1, 0.4, 0.2, 0.3], 0.3, 0.5),
+    ],
+)
+def test_summary_uses_nearest_rank(samples: list, p50: float, p95: float) -> None:
+    """p95 of a small session includes the slowest turn."""
+    stats = LatencyStats()
+    for ttfb in samples:
+        stats.collect(_tts(ttfb))
+
+    assert (
+        stats.get_summary()
+        == f"tts_ttfb p50={p50:.3f}s p95={p95:.3f}s n={len(samples)}"
+    )